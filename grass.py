@@ -2,7 +2,19 @@ import hid
 import time
 import struct
 import math
-import pyautogui
+import ctypes
+import numpy as np
+
+# パケット内のクォータニオン (offset 4 から big-endian int32 ×4)
+_UNPACK = struct.Struct('>iiii').unpack_from
+
+try:
+    from numba import njit
+except ImportError:
+    # numba が無い環境では通常のPython関数として動かす
+    def njit(*args, **kwargs):
+        if args and callable(args[0]): return args[0]
+        return lambda f: f
 
 # --- 設定エリア ---
 VENDOR_ID = 0x4817
@@ -12,6 +24,7 @@ PRODUCT_ID = 0x4242
 RANGE_X_DEG = 25.0
 RANGE_Y_DEG = 15.0
 SMOOTHING = 0.2
+SMOOTHING_INTERVAL = 0.01  # SMOOTHING はこの間隔 (秒) あたりの追従率
 
 # ■ クリックの感度（首をかしげる角度）
 CLICK_THRESHOLD = 20.0  # 20度以上傾けるとクリック
@@ -19,39 +32,157 @@ CLICK_THRESHOLD = 20.0  # 20度以上傾けるとクリック
 # 反転設定
 INVERT_X = True
 INVERT_Y = False
-
-pyautogui.FAILSAFE = False
 # ------------------
 
+# === Win32 マウス入力 (SendInput直叩き) ===
+user32 = ctypes.windll.user32
+user32.SetProcessDPIAware()
+
+INPUT_MOUSE = 0
+MOUSEEVENTF_MOVE = 0x0001
+MOUSEEVENTF_LEFTDOWN = 0x0002
+MOUSEEVENTF_LEFTUP = 0x0004
+MOUSEEVENTF_RIGHTDOWN = 0x0008
+MOUSEEVENTF_RIGHTUP = 0x0010
+MOUSEEVENTF_ABSOLUTE = 0x8000
+
+class MOUSEINPUT(ctypes.Structure):
+    _fields_ = [
+        ("dx", ctypes.c_long),
+        ("dy", ctypes.c_long),
+        ("mouseData", ctypes.c_ulong),
+        ("dwFlags", ctypes.c_ulong),
+        ("time", ctypes.c_ulong),
+        ("dwExtraInfo", ctypes.c_size_t),
+    ]
+
+class INPUT(ctypes.Structure):
+    _fields_ = [("type", ctypes.c_ulong), ("mi", MOUSEINPUT)]
+
+class POINT(ctypes.Structure):
+    _fields_ = [("x", ctypes.c_long), ("y", ctypes.c_long)]
+
+# 毎回作らずに使い回す
+_move_input = INPUT(type=INPUT_MOUSE, mi=MOUSEINPUT(dwFlags=MOUSEEVENTF_MOVE | MOUSEEVENTF_ABSOLUTE))
+_left_click = (INPUT * 2)(
+    INPUT(type=INPUT_MOUSE, mi=MOUSEINPUT(dwFlags=MOUSEEVENTF_LEFTDOWN)),
+    INPUT(type=INPUT_MOUSE, mi=MOUSEINPUT(dwFlags=MOUSEEVENTF_LEFTUP)),
+)
+_right_click = (INPUT * 2)(
+    INPUT(type=INPUT_MOUSE, mi=MOUSEINPUT(dwFlags=MOUSEEVENTF_RIGHTDOWN)),
+    INPUT(type=INPUT_MOUSE, mi=MOUSEINPUT(dwFlags=MOUSEEVENTF_RIGHTUP)),
+)
+_INPUT_SIZE = ctypes.sizeof(INPUT)
+
+def move_cursor(x, y):
+    # ABSOLUTE指定は 0～65535 の正規化座標
+    _move_input.mi.dx = int(x * 65535 / (SCREEN_W - 1))
+    _move_input.mi.dy = int(y * 65535 / (SCREEN_H - 1))
+    user32.SendInput(1, ctypes.byref(_move_input), _INPUT_SIZE)
+
+def left_click():
+    user32.SendInput(2, _left_click, _INPUT_SIZE)
+
+def right_click():
+    user32.SendInput(2, _right_click, _INPUT_SIZE)
+
+def get_cursor_pos():
+    pt = POINT()
+    user32.GetCursorPos(ctypes.byref(pt))
+    return pt.x, pt.y
+
+@njit(cache=True)
 def quaternion_to_euler(v0, v1, v2, v3):
-    norm = math.sqrt(v0**2 + v1**2 + v2**2 + v3**2)
-    if norm == 0: return 0, 0, 0
-    w, x, y, z = v0/norm, v1/norm, v2/norm, v3/norm
+    # Bernardes & Viollet の直接変換式 (x-y-z 外因性 = Z-Y-X 内因性)
+    # atan2 はスケール不変なので正規化は不要
+    w, x, y, z = v0, v1, v2, v3
+    a = w - y
+    b = x + z
+    c = y + w
+    d = z - x
+    if a == 0 and b == 0 and c == 0 and d == 0: return 0.0, 0.0, 0.0
 
-    # Roll (赤: 上下 / Pitch)
-    sinr_cosp = 2 * (w * x + y * z)
-    cosr_cosp = 1 - 2 * (x * x + y * y)
-    angle_pitch = math.degrees(math.atan2(sinr_cosp, cosr_cosp))
+    t_plus = math.atan2(b, a)
+    t_minus = math.atan2(d, c)
 
+    # Roll (赤: 上下 / Pitch)
+    angle_pitch = math.degrees(t_plus - t_minus)
     # Yaw (青: 左右 / Yaw)
-    siny_cosp = 2 * (w * z + x * y)
-    cosy_cosp = 1 - 2 * (y * y + z * z)
-    angle_yaw = math.degrees(math.atan2(siny_cosp, cosy_cosp))
-    
-    # ★追加: Tilt (緑: 首かしげ / Roll)
-    # クォータニオンからの変換式
-    sinp = 2 * (w * y - z * x)
-    if abs(sinp) >= 1:
-        angle_roll = math.copysign(90, sinp)
-    else:
-        angle_roll = math.degrees(math.asin(sinp))
+    angle_yaw = math.degrees(t_plus + t_minus)
+    # Tilt (緑: 首かしげ / Roll)
+    angle_roll = math.degrees(2 * math.atan2(math.hypot(c, d), math.hypot(a, b))) - 90.0
+
+    # ±180 の範囲に戻す
+    if angle_pitch > 180: angle_pitch -= 360
+    elif angle_pitch < -180: angle_pitch += 360
+    if angle_yaw > 180: angle_yaw -= 360
+    elif angle_yaw < -180: angle_yaw += 360
+
+    return angle_pitch, angle_yaw, angle_roll
 
+def quaternion_to_euler_batch(q):
+    # quaternion_to_euler の一括版 (q: N×4 配列、戻り値は各列の角度配列)
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    a = w - y
+    b = x + z
+    c = y + w
+    d = z - x
+    t_plus = np.arctan2(b, a)
+    t_minus = np.arctan2(d, c)
+    angle_pitch = (np.degrees(t_plus - t_minus) + 180.0) % 360.0 - 180.0
+    angle_yaw = (np.degrees(t_plus + t_minus) + 180.0) % 360.0 - 180.0
+    angle_roll = np.degrees(2 * np.arctan2(np.hypot(c, d), np.hypot(a, b))) - 90.0
+    # スカラー版と同様、ゼロのクォータニオンは (0, 0, 0) 扱い
+    zero = ~np.any(q != 0, axis=1)
+    angle_pitch[zero] = 0.0
+    angle_yaw[zero] = 0.0
+    angle_roll[zero] = 0.0
     return angle_pitch, angle_yaw, angle_roll
 
 # 画面サイズ
-SCREEN_W, SCREEN_H = pyautogui.size()
+SCREEN_W, SCREEN_H = user32.GetSystemMetrics(0), user32.GetSystemMetrics(1)
 CENTER_X = SCREEN_W / 2
 CENTER_Y = SCREEN_H / 2
+# 角度差 → ピクセルの倍率 (反転の符号もここで掛けておく)
+SCALE_X = (SCREEN_W * 0.5) / RANGE_X_DEG
+SCALE_Y = (SCREEN_H * 0.5) / RANGE_Y_DEG
+if INVERT_X: SCALE_X = -SCALE_X
+if INVERT_Y: SCALE_Y = -SCALE_Y
+
+@njit(cache=True)
+def process_sample(v0, v1, v2, v3, base_pitch, base_yaw, base_roll, cursor_x, cursor_y, screen, dt):
+    # 1サンプル分の計算 (角度変換 → 差分 → カーソル位置) をまとめてJITコンパイルする
+    # screen: (中心X, 中心Y, 倍率X, 倍率Y, 最大X, 最大Y)
+    #   実行時に決まる値なので引数で渡す (グローバルだとコンパイル時の値がキャッシュに焼き付く)
+    # dt: 前回のサンプルからの経過秒数 (IMUのレートに関係なく同じ追従速度にする)
+    # 戻り値: (新しいカーソルX, 新しいカーソルY, クリック判定用のRoll差分)
+    center_x, center_y, scale_x, scale_y, max_x, max_y = screen
+    raw_p, raw_y, raw_r = quaternion_to_euler(v0, v1, v2, v3)
+
+    # 差分計算
+    diff_pitch = raw_p - base_pitch
+    diff_yaw = raw_y - base_yaw
+    diff_roll = raw_r - base_roll # クリック判定用
+
+    # 180度補正
+    if diff_pitch > 180: diff_pitch -= 360
+    elif diff_pitch < -180: diff_pitch += 360
+    if diff_yaw > 180: diff_yaw -= 360
+    elif diff_yaw < -180: diff_yaw += 360
+    if diff_roll > 180: diff_roll -= 360
+    elif diff_roll < -180: diff_roll += 360
+
+    # --- マウス移動 ---
+    target_x = center_x + diff_yaw * scale_x
+    target_y = center_y + diff_pitch * scale_y
+    
+    target_x = max(0.0, min(max_x, target_x))
+    target_y = max(0.0, min(max_y, target_y))
+
+    alpha = 1.0 - (1.0 - SMOOTHING) ** (dt / SMOOTHING_INTERVAL)
+    cursor_x += (target_x - cursor_x) * alpha
+    cursor_y += (target_y - cursor_y) * alpha
+    return cursor_x, cursor_y, diff_roll
 
 print(f"=== Head Mouse + Tilt Click ===")
 print("Ctrl+C で終了")
@@ -72,91 +203,79 @@ try:
     h.set_nonblocking(1)
 
     # キャリブレーション
-    base_pitch = 0
-    base_yaw = 0
-    base_roll = 0
+    # 生データを溜めておき、最後にまとめて角度へ変換する
+    CALIB_MAX_SAMPLES = 8000
+    calib_buf = np.empty((CALIB_MAX_SAMPLES, 4), dtype=np.float64)
     samples = 0
     
     for _ in range(10): h.read(64)
 
     start_calib = time.time()
     while time.time() - start_calib < 3.0:
-        data = h.read(64)
-        if data and len(data) >= 20:
-            vals = struct.unpack('>iiii', bytearray(data[4:20]))
-            p, y, r = quaternion_to_euler(vals[0], vals[1], vals[2], vals[3])
-            base_pitch += p
-            base_yaw += y
-            base_roll += r
+        data = h.read(64, timeout_ms=10)
+        if data and len(data) >= 20 and samples < CALIB_MAX_SAMPLES:
+            calib_buf[samples] = np.frombuffer(bytes(data[4:20]), dtype='>i4')
             samples += 1
-        time.sleep(0.01)
     
     if samples == 0: exit()
 
-    base_pitch /= samples
-    base_yaw /= samples
-    base_roll /= samples
+    calib_p, calib_y, calib_r = quaternion_to_euler_batch(calib_buf[:samples])
+    base_pitch = float(calib_p.mean())
+    base_yaw = float(calib_y.mean())
+    base_roll = float(calib_r.mean())
     
     print(">>> 操作スタート！ <<<")
     print("  - 右に首をかしげる: 左クリック")
     print("  - 左に首をかしげる: 右クリック")
 
-    curr_cursor_x, curr_cursor_y = pyautogui.position()
+    curr_cursor_x, curr_cursor_y = get_cursor_pos()
+    curr_cursor_x, curr_cursor_y = float(curr_cursor_x), float(curr_cursor_y)
+    screen = (float(CENTER_X), float(CENTER_Y), float(SCALE_X), float(SCALE_Y),
+              float(SCREEN_W - 1), float(SCREEN_H - 1))
+
+    # 最初の実サンプルでJITコンパイル待ちが起きないよう、ここで一度呼んでおく
+    process_sample(1, 0, 0, 0, base_pitch, base_yaw, base_roll, curr_cursor_x, curr_cursor_y, screen, SMOOTHING_INTERVAL)
+    last_sample_t = time.perf_counter()
+    sent_x, sent_y = -1, -1
     
     # クリック状態管理（連打防止）
-    is_clicking = False
+    # 状態ビット → (送信関数, 表示メッセージ)
+    CLICK_ACTIONS = (None, (left_click, "Left Click!"), (right_click, "Right Click!"))
+    click_state = 0
 
     while True:
-        data = h.read(64)
+        # パケットが届くまで最大5ms待ち、溜まっていた分は読み捨てて最新だけ使う
+        data = h.read(64, timeout_ms=5)
+        while data:
+            d = h.read(64)
+            if not d: break
+            data = d
         if data and len(data) >= 20:
-            vals = struct.unpack('>iiii', bytearray(data[4:20]))
-            raw_p, raw_y, raw_r = quaternion_to_euler(vals[0], vals[1], vals[2], vals[3])
-
-            # 差分計算
-            diff_pitch = raw_p - base_pitch
-            diff_yaw = raw_y - base_yaw
-            diff_roll = raw_r - base_roll # クリック判定用
-
-            # 180度補正
-            for d in [diff_pitch, diff_yaw, diff_roll]:
-                if d > 180: d -= 360
-                if d < -180: d += 360
-
-            # --- マウス移動 ---
-            if INVERT_X: diff_yaw *= -1
-            if INVERT_Y: diff_pitch *= -1
-
-            target_x = CENTER_X + (diff_yaw / RANGE_X_DEG) * (SCREEN_W / 2)
-            target_y = CENTER_Y + (diff_pitch / RANGE_Y_DEG) * (SCREEN_H / 2)
-            
-            target_x = max(0, min(SCREEN_W - 1, target_x))
-            target_y = max(0, min(SCREEN_H - 1, target_y))
-
-            curr_cursor_x += (target_x - curr_cursor_x) * SMOOTHING
-            curr_cursor_y += (target_y - curr_cursor_y) * SMOOTHING
-            
-            pyautogui.moveTo(curr_cursor_x, curr_cursor_y, duration=0)
+            vals = _UNPACK(bytes(data), 4)
+            now = time.perf_counter()
+            curr_cursor_x, curr_cursor_y, diff_roll = process_sample(
+                vals[0], vals[1], vals[2], vals[3],
+                base_pitch, base_yaw, base_roll, curr_cursor_x, curr_cursor_y, screen,
+                now - last_sample_t)
+            last_sample_t = now
+
+            # ピクセルが変わった時だけ送る (IMUのレートでSendInputを撃たない)
+            if int(curr_cursor_x) != sent_x or int(curr_cursor_y) != sent_y:
+                sent_x, sent_y = int(curr_cursor_x), int(curr_cursor_y)
+                move_cursor(curr_cursor_x, curr_cursor_y)
 
             # --- クリック判定 ---
-            # 右にかしげる (Roll > Threshold) -> 左クリック
-            if diff_roll > CLICK_THRESHOLD:
-                if not is_clicking:
-                    pyautogui.click() # 左クリック
-                    print("Left Click!")
-                    is_clicking = True
-            
-            # 左にかしげる (Roll < -Threshold) -> 右クリック
-            elif diff_roll < -CLICK_THRESHOLD:
-                if not is_clicking:
-                    pyautogui.rightClick() # 右クリック
-                    print("Right Click!")
-                    is_clicking = True
-            
+            # bit0: 右にかしげる (Roll > Threshold) -> 左クリック
+            # bit1: 左にかしげる (Roll < -Threshold) -> 右クリック
+            desired = (diff_roll > CLICK_THRESHOLD) | ((diff_roll < -CLICK_THRESHOLD) << 1)
+            if desired and not click_state:
+                click_fn, click_msg = CLICK_ACTIONS[desired]
+                click_fn()
+                print(click_msg)
+                click_state = desired
             # 頭を戻した (不感帯に戻った)
             elif abs(diff_roll) < (CLICK_THRESHOLD - 5):
-                is_clicking = False
-
-        time.sleep(0.01)
+                click_state = 0
 
 except KeyboardInterrupt:
     print("\n終了")
@@ -9,12 +9,16 @@ import struct
 import traceback
 import datetime
 
+# IMUパケット内のクォータニオン (offset 4 から big-endian int32 ×4)
+_UNPACK = struct.Struct('>iiii').unpack_from
+
 # === ログ保存機能 ===
 class DualLogger:
     def __init__(self):
         filename = f"log_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
         self.terminal = sys.stdout
-        self.log_file = open(filename, "w", encoding='utf-8')
+        # 行バッファリング (改行ごとに書き出す) にして write のたびの flush をやめる
+        self.log_file = open(filename, "w", encoding='utf-8', buffering=1)
         start_msg = f"=== Log Started: {filename} ===\n"
         self.terminal.write(start_msg)
         self.log_file.write(start_msg)
@@ -22,7 +26,6 @@ class DualLogger:
     def write(self, message):
         self.terminal.write(message)
         self.log_file.write(message)
-        self.log_file.flush()
 
     def flush(self):
         self.terminal.flush()
@@ -54,6 +57,26 @@ try:
             except: pass
             self._duplicator = None
     dxcam.DXCamera.release = patched_release
+
+    # get_latest_frame() は毎回 np.array() で新しい配列を確保するので、
+    # out を渡した場合は用意済みのバッファへコピーする
+    # (コピーはロックの外で行い、キャプチャスレッドを待たせない)
+    _orig_get_latest_frame = dxcam.DXCamera.get_latest_frame
+    _frame_attrs = ('_DXCamera__frame_available', '_DXCamera__lock',
+                    '_DXCamera__frame_buffer', '_DXCamera__head', 'max_buffer_len')
+    def patched_get_latest_frame(self, out=None):
+        if out is None or not all(hasattr(self, a) for a in _frame_attrs):
+            frame = _orig_get_latest_frame(self)
+            if out is None or frame is None: return frame
+            np.copyto(out, frame)
+            return out
+        self._DXCamera__frame_available.wait()
+        with self._DXCamera__lock:
+            frame = self._DXCamera__frame_buffer[(self._DXCamera__head - 1) % self.max_buffer_len]
+            self._DXCamera__frame_available.clear()
+        np.copyto(out, frame)
+        return out
+    dxcam.DXCamera.get_latest_frame = patched_get_latest_frame
     # ----------------------
 
 except ImportError as e:
@@ -89,7 +112,7 @@ INVERT_YAW = False
 INVERT_ROLL = True
 
 # === シェーダー ===
-# メイン画面用
+# メイン画面とFPS表示を同じプログラム・VAOで描く (u_ui_mode で切り替え)
 VERTEX_SHADER = '''
 #version 330
 in vec3 in_position;
@@ -97,9 +120,15 @@ in vec2 in_texcoord;
 uniform mat4 m_proj;
 uniform mat4 m_view;
 uniform mat4 m_model;
+uniform bool u_ui_mode;
 out vec2 v_texcoord;
 void main() {
-    gl_Position = m_proj * m_view * m_model * vec4(in_position, 1.0);
+    if (u_ui_mode) {
+        // FPS表示: 画面座標そのまま、深度は最前面
+        gl_Position = vec4(in_position.xy, -1.0, 1.0);
+    } else {
+        gl_Position = m_proj * m_view * m_model * vec4(in_position, 1.0);
+    }
     v_texcoord = in_texcoord; 
 }
 '''
@@ -107,34 +136,18 @@ void main() {
 FRAGMENT_SHADER = '''
 #version 330
 uniform sampler2D Texture;
-in vec2 v_texcoord;
-out vec4 f_color;
-void main() {
-    f_color = vec4(texture(Texture, v_texcoord).rgb, 1.0);
-}
-'''
-
-# FPS表示用
-UI_VERTEX_SHADER = '''
-#version 330
-in vec2 in_pos;
-in vec2 in_uv;
-out vec2 v_uv;
-void main() {
-    gl_Position = vec4(in_pos, 0.0, 1.0);
-    v_uv = in_uv;
-}
-'''
-
-UI_FRAGMENT_SHADER = '''
-#version 330
 uniform sampler2D uiTexture;
-in vec2 v_uv;
+uniform bool u_ui_mode;
+in vec2 v_texcoord;
 out vec4 f_color;
 void main() {
-    vec4 c = texture(uiTexture, v_uv);
-    if(c.a < 0.1) discard;
-    f_color = c;
+    if (u_ui_mode) {
+        vec4 c = texture(uiTexture, v_texcoord);
+        if(c.a < 0.1) discard;
+        f_color = c;
+    } else {
+        f_color = vec4(texture(Texture, v_texcoord).rgb, 1.0);
+    }
 }
 '''
 
@@ -209,61 +222,87 @@ class VirtualDisplayManager:
 
 # --- メッシュ生成 ---
 def create_mesh(radius, arc_deg, aspect, segs):
-    verts, inds = [], []
     w_arc = radius * math.radians(arc_deg)
     h = w_arc / aspect
     half_ang = math.radians(arc_deg) / 2.0
-    for i in range(segs + 1):
-        t = i / segs
-        theta = -half_ang + (t * 2 * half_ang)
-        x = radius * math.sin(theta)
-        z = -radius * math.cos(theta)
-        verts.extend([x, h/2, z, t, 0.0])
-        verts.extend([x, -h/2, z, t, 1.0])
-    for i in range(segs):
-        base = i * 2
-        inds.extend([base, base+1, base+2, base+2, base+1, base+3])
-    return np.array(verts, dtype='f4'), np.array(inds, dtype='i4')
+    t = np.arange(segs + 1, dtype='f4') / segs
+    theta = -half_ang + t * (2 * half_ang)
+    x = radius * np.sin(theta)
+    z = -radius * np.cos(theta)
+    # 1列につき上端・下端の2頂点 (x, y, z, u, v)
+    verts = np.empty((segs + 1, 2, 5), dtype='f4')
+    verts[:, :, 0] = x[:, None]
+    verts[:, 0, 1] = h/2
+    verts[:, 1, 1] = -h/2
+    verts[:, :, 2] = z[:, None]
+    verts[:, :, 3] = t[:, None]
+    verts[:, 0, 4] = 0.0
+    verts[:, 1, 4] = 1.0
+    base = np.arange(segs, dtype='i4')[:, None] * 2
+    inds = base + np.array([0, 1, 2, 2, 1, 3], dtype='i4')
+    return verts.reshape(-1), inds.reshape(-1)
 
 # --- FPS表示クラス ---
 class FpsOverlay:
+    MAX_DIGITS = 3  # 表示する桁数
+
+    # 右上配置 (x, y, z, u, v) ※描画はメインのVAOにまとめて行う
+    VERTICES = np.array([
+        0.85, 0.95, 0.0, 0.0, 1.0,
+        0.85, 0.85, 0.0, 0.0, 0.0,
+        0.98, 0.85, 0.0, 1.0, 0.0,
+        0.85, 0.95, 0.0, 0.0, 1.0,
+        0.98, 0.85, 0.0, 1.0, 0.0,
+        0.98, 0.95, 0.0, 1.0, 1.0,
+    ], dtype='f4')
+
     def __init__(self, ctx):
         self.ctx = ctx
-        self.prog = ctx.program(vertex_shader=UI_VERTEX_SHADER, fragment_shader=UI_FRAGMENT_SHADER)
         self.font = pygame.font.SysFont("Arial", 24, bold=True)
         self.tex_w, self.tex_h = 150, 50
         self.texture = self.ctx.texture((self.tex_w, self.tex_h), 4)
         self.texture.filter = (moderngl.LINEAR, moderngl.LINEAR)
-        
-        # 右上配置
-        vertices = np.array([
-            0.85, 0.95, 0.0, 1.0,
-            0.85, 0.85, 0.0, 0.0,
-            0.98, 0.85, 1.0, 0.0,
-            0.85, 0.95, 0.0, 1.0,
-            0.98, 0.85, 1.0, 0.0,
-            0.98, 0.95, 1.0, 1.0,
-        ], dtype='f4')
-        self.vbo = self.ctx.buffer(vertices)
-        self.vao = self.ctx.vertex_array(self.prog, [(self.vbo, '2f 2f', 'in_pos', 'in_uv')])
         self.surface = pygame.Surface((self.tex_w, self.tex_h), pygame.SRCALPHA)
         self.last_update = 0
 
-    def render(self, fps_val):
+        # 背景と "FPS: " は最初に一度だけ転送し、以降は数字の部分だけ書き換える
+        text_color, bg_color = (0, 255, 0), (0, 0, 0, 150)
+        label = self.font.render("FPS: ", True, text_color)
+        digits = [self.font.render(str(n), True, text_color) for n in range(10)]
+        self.digit_w = max(g.get_width() for g in digits)
+        self.digit_h = max(g.get_height() for g in digits)
+        total_w = label.get_width() + self.digit_w * self.MAX_DIGITS
+        text_x = (self.tex_w - total_w) // 2
+        text_y = (self.tex_h - self.digit_h) // 2
+        self.digit_x = text_x + label.get_width()
+        # テクスチャは上下反転で転送しているので、書き込み先のyも反転させる
+        self.digit_vp_y = self.tex_h - text_y - self.digit_h
+
+        self.surface.fill((0,0,0,0))
+        pygame.draw.rect(self.surface, bg_color, (0, 0, self.tex_w, self.tex_h), border_radius=5)
+        self.surface.blit(label, (text_x, text_y))
+        self.texture.write(pygame.image.tostring(self.surface, 'RGBA', True))
+
+        # 数字グリフ (背景込み) を転送用バイト列として事前に作っておく
+        def make_glyph(g):
+            tile = pygame.Surface((self.digit_w, self.digit_h), pygame.SRCALPHA)
+            tile.fill(bg_color)
+            if g: tile.blit(g, g.get_rect(center=(self.digit_w//2, self.digit_h//2)))
+            return pygame.image.tostring(tile, 'RGBA', True)
+        self.glyphs = {str(n): make_glyph(g) for n, g in enumerate(digits)}
+        self.glyphs[' '] = make_glyph(None)
+        self.shown = ' ' * self.MAX_DIGITS
+
+    def update(self, fps_val):
         now = time.time()
         if now - self.last_update > 0.2:
-            self.surface.fill((0,0,0,0))
-            pygame.draw.rect(self.surface, (0, 0, 0, 150), (0, 0, self.tex_w, self.tex_h), border_radius=5)
-            text = self.font.render(f"FPS: {int(fps_val)}", True, (0, 255, 0))
-            rect = text.get_rect(center=(self.tex_w//2, self.tex_h//2))
-            self.surface.blit(text, rect)
-            self.texture.write(pygame.image.tostring(self.surface, 'RGBA', True))
+            text = str(min(int(fps_val), 10**self.MAX_DIGITS - 1)).ljust(self.MAX_DIGITS)
+            for i, (c, prev) in enumerate(zip(text, self.shown)):
+                if c != prev:
+                    vp = (self.digit_x + i * self.digit_w, self.digit_vp_y, self.digit_w, self.digit_h)
+                    self.texture.write(self.glyphs[c], viewport=vp)
+            self.shown = text
             self.last_update = now
-        
-        self.ctx.disable(moderngl.DEPTH_TEST)
-        self.texture.use(0)
-        self.vao.render()
-        self.ctx.enable(moderngl.DEPTH_TEST)
 
 # --- メインビュワー ---
 def run_viewer():
@@ -344,14 +383,33 @@ def run_viewer():
     
     texture = ctx.texture((cw, ch), 3)
     texture.filter = (moderngl.LINEAR, moderngl.LINEAR)
+    # フレーム転送用PBO (bytesを経由せずnumpy配列から直接書き込む)
+    # 2枚を交互に使い、前フレームの転送・描画と今回の書き込みを重ねる
+    pbo = [ctx.buffer(reserve=cw * ch * 3, dynamic=True) for _ in range(2)]
+    pbo_idx = 0
+    # キャプチャ結果の受け皿 (毎フレーム使い回す)
+    frame_buf = np.empty((ch, cw, 3), dtype=np.uint8)
     
-    def update_mesh():
-        vbo_d, ibo_d = create_mesh(VIEWER_CONFIG['RADIUS'], VIEWER_CONFIG['ARC_ANGLE'], cw/ch, VIEWER_CONFIG['SEGMENTS'])
-        vbo = ctx.buffer(vbo_d); ibo = ctx.buffer(ibo_d)
-        vao = ctx.vertex_array(prog, [(vbo, '3f 2f', 'in_position', 'in_texcoord')], ibo)
-        return vbo, ibo, vao
-
-    vbo, ibo, vao = update_mesh()
+    def build_mesh():
+        return create_mesh(VIEWER_CONFIG['RADIUS'], VIEWER_CONFIG['ARC_ANGLE'], cw/ch, VIEWER_CONFIG['SEGMENTS'])
+
+    # 分割数は固定なので頂点数・インデックスは変わらない。
+    # バッファとVAOは一度だけ作り、湾曲変更時は頂点データだけ書き換える
+    # メッシュの後ろにFPS表示の四角形をつなげ、同じVAOから2回に分けて描く
+    vbo_d, ibo_d = build_mesh()
+    mesh_vert_n = len(vbo_d) // 5
+    mesh_index_n = len(ibo_d)
+    ui_d = FpsOverlay.VERTICES
+    ui_index_n = len(ui_d) // 5
+    vbo = ctx.buffer(np.concatenate([vbo_d, ui_d]), dynamic=True)
+    ibo = ctx.buffer(np.concatenate([ibo_d, mesh_vert_n + np.arange(ui_index_n, dtype='i4')]))
+    vao = ctx.vertex_array(prog, [(vbo, '3f 2f', 'in_position', 'in_texcoord')], ibo)
+
+    # テクスチャユニットは固定 (0: キャプチャ画面, 1: FPS表示)
+    prog['Texture'].value = 0
+    prog['uiTexture'].value = 1
+    texture.use(0)
+    fps_overlay.texture.use(1)
 
     # IMU接続
     h_imu = None
@@ -361,7 +419,27 @@ def run_viewer():
         h_imu.open_path(path)
         h_imu.set_nonblocking(1)
         print("IMU Connected.")
-    except: pass
+    except: h_imu = None
+
+    # IMU読み取りスレッド (描画ループのフレーム時間に引きずられないよう分離)
+    # 最新の1サンプル (w, x, y, z) だけを imu_latest[0] に置く (参照の代入はアトミック)
+    # 描画側はスロットに書き込まず、前回処理したオブジェクトとの同一性で新着を判定する
+    imu_latest = [None]
+    imu_last = None
+    imu_stop = threading.Event()
+
+    def poll_imu():
+        while not imu_stop.is_set():
+            try:
+                d = h_imu.read(64, timeout_ms=50)
+            except: break
+            if d and len(d) >= 20:
+                imu_latest[0] = _UNPACK(bytes(d), 4)
+
+    imu_thread = None
+    if h_imu:
+        imu_thread = threading.Thread(target=poll_imu, daemon=True)
+        imu_thread.start()
 
     base_q = glm.quat(1,0,0,0)
     curr_q = glm.quat(1,0,0,0)
@@ -369,6 +447,10 @@ def run_viewer():
     running = True
     need_reset = True 
     is_fullscreen = False
+    # 射影行列はウィンドウサイズかFOVが変わった時だけ作り直す
+    win_w, win_h = pygame.display.get_surface().get_size()
+    proj_dirty = True
+    prog['m_model'].write(glm.mat4(1.0))
 
     print("\n=== 操作ガイド ===")
     print(" [SPACE]        : 視点リセット")
@@ -377,13 +459,20 @@ def run_viewer():
     print(" [ESC]          : 終了")
     print("==================")
 
+    keys = None
+    def key_down(pg_key, vk):
+        if keys is not None: return keys[pg_key]
+        return win32api.GetAsyncKeyState(vk) & 0x8000
+
     while running:
         dt = clock.tick(144) / 1000.0
         fps_val = clock.get_fps()
         
         for event in pygame.event.get():
             if event.type == QUIT: running = False
-            if event.type == VIDEORESIZE: ctx.viewport = (0,0,event.w,event.h)
+            if event.type == VIDEORESIZE:
+                ctx.viewport = (0,0,event.w,event.h)
+                win_w, win_h = event.w, event.h; proj_dirty = True
             if event.type == KEYDOWN:
                 if event.key == K_ESCAPE: running = False
                 if event.key == K_SPACE:
@@ -392,77 +481,90 @@ def run_viewer():
                     is_fullscreen = not is_fullscreen
                     if is_fullscreen: pygame.display.toggle_fullscreen()
                     else: pygame.display.toggle_fullscreen()
+                    win_w, win_h = pygame.display.get_surface().get_size(); proj_dirty = True
 
         # --- 入力処理 ---
         rebuild = False
-        is_alt = win32api.GetAsyncKeyState(win32con.VK_MENU) & 0x8000
+        # フォーカス中はイベント処理済みのpygameのキー状態を使う。
+        # 仮想ディスプレイ側を操作中 (非フォーカス) でも効くよう、その時は GetAsyncKeyState で読む
+        keys = pygame.key.get_pressed() if pygame.key.get_focused() else None
+        if keys is not None: is_alt = keys[K_LALT] or keys[K_RALT]
+        else: is_alt = win32api.GetAsyncKeyState(win32con.VK_MENU) & 0x8000
         if is_alt:
             # Zoom In (FOVを小さく)
-            if win32api.GetAsyncKeyState(win32con.VK_UP) & 0x8000:
-                VIEWER_CONFIG['FOV'] = max(10.0, VIEWER_CONFIG['FOV'] - 30.0 * dt)
+            if key_down(K_UP, win32con.VK_UP):
+                VIEWER_CONFIG['FOV'] = max(10.0, VIEWER_CONFIG['FOV'] - 30.0 * dt); proj_dirty = True
             # Zoom Out (FOVを大きく)
-            if win32api.GetAsyncKeyState(win32con.VK_DOWN) & 0x8000:
-                VIEWER_CONFIG['FOV'] = min(120.0, VIEWER_CONFIG['FOV'] + 30.0 * dt)
+            if key_down(K_DOWN, win32con.VK_DOWN):
+                VIEWER_CONFIG['FOV'] = min(120.0, VIEWER_CONFIG['FOV'] + 30.0 * dt); proj_dirty = True
                 
             # Curve (湾曲)
-            if win32api.GetAsyncKeyState(win32con.VK_LEFT) & 0x8000:
+            if key_down(K_LEFT, win32con.VK_LEFT):
                 VIEWER_CONFIG['ARC_ANGLE'] = max(10.0, VIEWER_CONFIG['ARC_ANGLE'] - 30.0 * dt); rebuild = True
-            if win32api.GetAsyncKeyState(win32con.VK_RIGHT) & 0x8000:
+            if key_down(K_RIGHT, win32con.VK_RIGHT):
                 VIEWER_CONFIG['ARC_ANGLE'] += 30.0 * dt; rebuild = True
         
         if rebuild:
-            vbo.release(); ibo.release(); vao.release()
-            vbo, ibo, vao = update_mesh()
+            vbo_d, _ = build_mesh()
+            vbo.orphan(); vbo.write(vbo_d); vbo.write(ui_d, offset=vbo_d.nbytes)
 
         # IMU
-        if h_imu:
+        raw_v = imu_latest[0]
+        if raw_v is not None and raw_v is not imu_last:
+            imu_last = raw_v
             try:
-                last_d = None
-                while True:
-                    d = h_imu.read(64)
-                    if not d: break
-                    last_d = d
-                if last_d:
-                    v = struct.unpack('>iiii', bytearray(last_d[4:20]))
-                    norm = math.sqrt(sum(x*x for x in v))
-                    if norm > 0:
-                        w, x, y, z = v[0]/norm, v[1]/norm, v[2]/norm, v[3]/norm
-                        if not INVERT_PITCH: x = -x
-                        if INVERT_YAW: y = -y
-                        if INVERT_ROLL: z = -z
-                        raw_q = glm.quat(w, x, y, z)
-                        if need_reset: base_q = raw_q; need_reset = False
-                        curr_q = glm.slerp(curr_q, raw_q, 0.15)
+                w, x, y, z = raw_v
+                norm = math.sqrt(w*w + x*x + y*y + z*z)
+                if norm > 0:
+                    w, x, y, z = w/norm, x/norm, y/norm, z/norm
+                    if not INVERT_PITCH: x = -x
+                    if INVERT_YAW: y = -y
+                    if INVERT_ROLL: z = -z
+                    raw_q = glm.quat(w, x, y, z)
+                    if need_reset: base_q = raw_q; need_reset = False
+                    # 差分が小さいので slerp ではなく nlerp で十分 (短い方の経路を取る)
+                    if glm.dot(curr_q, raw_q) < 0: raw_q = -raw_q
+                    curr_q = glm.normalize(curr_q * (1 - 0.15) + raw_q * 0.15)
             except: pass
 
         # カメラ更新
         try:
-            img = camera.get_latest_frame() 
+            img = camera.get_latest_frame(out=frame_buf)
             if img is not None:
-                texture.write(img.tobytes())
+                pbo[pbo_idx].write(img)
+                texture.write(pbo[pbo_idx])
+                pbo_idx ^= 1
         except: pass
 
         ctx.clear(0.0, 0.0, 0.0)
         
-        view_q = glm.inverse(base_q) * curr_q
-        view_rot = glm.mat4_cast(glm.inverse(view_q))
-        prog['m_view'].write(glm.translate(glm.vec3(0,0,0)) * view_rot)
+        # inverse(inverse(base_q) * curr_q) = inverse(curr_q) * base_q
+        # curr_q は単位クォータニオンなので inverse は共役で済む
+        view_rot = glm.mat4_cast(glm.conjugate(curr_q) * base_q)
+        prog['m_view'].write(view_rot)
         
         # FOV適用 (Zoom)
-        aspect_ratio = pygame.display.get_surface().get_width()/pygame.display.get_surface().get_height()
-        prog['m_proj'].write(glm.perspective(glm.radians(VIEWER_CONFIG['FOV']), aspect_ratio, 0.1, 100.0))
+        if proj_dirty:
+            aspect_ratio = win_w / max(1, win_h)
+            prog['m_proj'].write(glm.perspective(glm.radians(VIEWER_CONFIG['FOV']), aspect_ratio, 0.1, 100.0))
+            proj_dirty = False
         
-        prog['m_model'].write(glm.mat4(1.0))
-        texture.use(0)
-        vao.render()
+        fps_overlay.update(fps_val)
+
+        prog['u_ui_mode'].value = False
+        vao.render(vertices=mesh_index_n, first=0)
         
         # FPS描画
-        fps_overlay.render(fps_val)
+        prog['u_ui_mode'].value = True
+        vao.render(vertices=ui_index_n, first=mesh_index_n)
 
         pygame.display.flip()
 
     try: camera.stop(); camera.release()
     except: pass
+    for b in pbo: b.release()
+    imu_stop.set()
+    if imu_thread: imu_thread.join(timeout=1.0)
     if h_imu: h_imu.close()
     try: ctypes.windll.winmm.timeEndPeriod(1)
     except: pass